@@ -0,0 +1,340 @@
+#random access to gzip and xz compressed files
+#
+#Compressed captures are decompressed on demand rather than up front, so
+#reading a range deep inside a large file doesn't mean inflating
+#everything before it on every read.
+#
+#gzip streams can't be entered at an arbitrary point, so as a gzip file is
+#read we keep snapshots of the decompressor every SPAN bytes of output and
+#later reads restart from the nearest snapshot. zlib doesn't give us a way
+#to serialize its state, so these only live as long as the reader.
+#
+#xz files already carry an index of their blocks in the stream footer and
+#each block can be decompressed on its own, so nothing needs to be built.
+#Note that files made by single-threaded xz have a single block; use
+#"xz -T0" or "--block-size" to get something that's actually seekable.
+#Blocks are decompressed in bounded chunks and only the requested range is
+#kept, so reading a huge block is slow but doesn't hold it all in memory.
+
+import bisect
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    #python 2 needs the backports.lzma package
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+
+class CompressedFileError(ValueError):
+    """The file is compressed but can't be read"""
+    pass
+
+#everything opening or reading a compressed file may raise
+DECOMPRESS_ERRORS = (IOError, CompressedFileError, zlib.error)
+if lzma is not None:
+    DECOMPRESS_ERRORS += (lzma.LZMAError,)
+
+
+def open_compressed(file_name):
+    """Get a random access reader for file_name if it's a compressed file,
+    otherwise None
+
+    Raises CompressedFileError if the file is in a compressed format we
+    can't read.
+    """
+    with open(file_name, "rb") as handle:
+        magic = handle.read(len(XZ_MAGIC))
+
+    if magic.startswith(GZIP_MAGIC):
+        return GzipReader(file_name)
+    if magic == XZ_MAGIC:
+        if lzma is None:
+            raise CompressedFileError("Reading xz files needs the lzma "
+                                      "module (pip install backports.lzma)")
+        return XzReader(file_name)
+    return None
+
+
+class CompressedReader(object):
+    """Base class for random access readers of compressed files"""
+
+    def __init__(self, file_name):
+        self._handle = open(file_name, "rb")
+
+    def read(self, offset, size, progress=None):
+        """Read up to size bytes of decompressed data starting at offset
+
+        Keyword Arguments:
+        progress(done, total) -- Called as data is decompressed with how
+                                 many of the bytes that have to be
+                                 decompressed have been so far. It may
+                                 raise to abandon the read (Defaults to None)
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Close the underlying file"""
+        self._handle.close()
+
+
+class GzipReader(CompressedReader):
+    """Random access reader for (possibly multi-member) gzip files"""
+
+    CHUNK_SIZE = 64 * 1024
+    SPAN = 8 * 1024 * 1024
+
+    def __init__(self, file_name, span=SPAN):
+        super(GzipReader, self).__init__(file_name)
+        self._span = span
+
+        #sorted list of decompressed offsets, and the (compressed offset,
+        #decompressor state) we can restart from at each of them
+        self._outOffsets = [0]
+        self._checkpoints = [(0, self._newDecompressor())]
+
+    @staticmethod
+    def _newDecompressor():
+        """Make a decompressor for a single gzip member"""
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _addCheckpoint(self, out_offset, in_offset, decomp):
+        """Remember the decompressor state if out_offset is a span past the
+        furthest point we've decompressed to so far"""
+        if out_offset >= self._outOffsets[-1] + self._span:
+            self._outOffsets.append(out_offset)
+            self._checkpoints.append((in_offset, decomp.copy()))
+
+    def read(self, offset, size, progress=None):
+        if offset < 0:
+            raise ValueError("Negative offset %d" % offset)
+
+        idx = bisect.bisect_right(self._outOffsets, offset) - 1
+        out_offset = self._outOffsets[idx]
+        start = out_offset
+        in_offset, decomp = self._checkpoints[idx]
+        decomp = decomp.copy()
+
+        end = offset + size
+        pieces = []
+        pending = b""
+        self._handle.seek(in_offset)
+
+        while out_offset < end:
+            if not pending:
+                pending = self._handle.read(self.CHUNK_SIZE)
+
+            if pending:
+                #cap the output so a highly compressed chunk doesn't blow up
+                #in memory, whatever's left over comes back in unconsumed_tail
+                out = decomp.decompress(pending, self.CHUNK_SIZE)
+            else:
+                out = decomp.flush()
+
+            if out_offset + len(out) > offset:
+                pieces.append(out[max(0, offset - out_offset):end - out_offset])
+            out_offset += len(out)
+            if progress:
+                progress(out_offset - start, end - start)
+
+            if not pending:
+                break
+
+            if decomp.unused_data:
+                #reached the end of a gzip member, anything after it is
+                #either another member or trailing garbage
+                pending = decomp.unused_data
+                if len(pending) < len(GZIP_MAGIC):
+                    pending += self._handle.read(self.CHUNK_SIZE)
+                if not pending.startswith(GZIP_MAGIC):
+                    break
+                decomp = self._newDecompressor()
+            elif decomp.unconsumed_tail:
+                pending = decomp.unconsumed_tail
+            else:
+                pending = b""
+
+            self._addCheckpoint(out_offset,
+                                self._handle.tell() - len(pending), decomp)
+
+        return b"".join(pieces)
+
+
+class XzReader(CompressedReader):
+    """Random access reader for (possibly multi-stream) xz files"""
+
+    CHUNK_SIZE = 64 * 1024
+    #without max_length (backports.lzma, python < 3.5) the amount of input
+    #fed at once is all that bounds the output
+    UNBOUNDED_CHUNK_SIZE = 1024
+
+    def __init__(self, file_name):
+        super(XzReader, self).__init__(file_name)
+
+        #sorted list of decompressed offsets each block starts at, and the
+        #(stream header, compressed offset, padded size) for each block
+        self._outOffsets = []
+        self._blocks = []
+        self._readIndex()
+
+    def _readIndex(self):
+        """Read the block index of every stream in the file"""
+        self._handle.seek(0, 2)
+        pos = self._handle.tell()
+
+        #streams are walked from the end of the file backwards
+        streams = []
+        while pos > 0:
+            #smallest possible stream is a header and a footer
+            if pos < 24:
+                raise CompressedFileError("Truncated xz file")
+
+            self._handle.seek(pos - 4)
+            if self._handle.read(4) == b"\0\0\0\0":
+                #stream padding
+                pos -= 4
+                continue
+
+            self._handle.seek(pos - 12)
+            footer = self._handle.read(12)
+            if footer[10:] != b"YZ":
+                raise CompressedFileError("Invalid xz stream footer at %d" % pos)
+            index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+            index_start = pos - 12 - index_size
+            if index_start < 12:
+                raise CompressedFileError("Invalid xz index size at %d" % pos)
+
+            self._handle.seek(index_start)
+            records = _parse_xz_index(self._handle.read(index_size))
+            blocks_size = sum(_pad4(unpadded) for unpadded, _ in records)
+            stream_start = index_start - blocks_size - 12
+            if stream_start < 0:
+                raise CompressedFileError("Invalid xz index at %d" %
+                                          index_start)
+
+            self._handle.seek(stream_start)
+            stream_header = self._handle.read(12)
+            if not stream_header.startswith(XZ_MAGIC):
+                raise CompressedFileError("Invalid xz stream header at %d" %
+                                 stream_start)
+
+            streams.append((stream_header, stream_start + 12, records))
+            pos = stream_start
+
+        out_offset = 0
+        for stream_header, in_offset, records in reversed(streams):
+            for unpadded, uncompressed in records:
+                self._outOffsets.append(out_offset)
+                self._blocks.append((stream_header, in_offset,
+                                     _pad4(unpadded)))
+                out_offset += uncompressed
+                in_offset += _pad4(unpadded)
+        self._size = out_offset
+
+    def _iterBlock(self, idx):
+        """Decompress a single block, yielding its contents in chunks"""
+        stream_header, in_offset, padded_size = self._blocks[idx]
+
+        #a stream header followed by a lone block is enough for liblzma
+        #to give us the block's contents
+        decomp = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        bounded = hasattr(decomp, "needs_input")
+        if bounded:
+            chunk_size = self.CHUNK_SIZE
+        else:
+            chunk_size = self.UNBOUNDED_CHUNK_SIZE
+
+        pending = stream_header
+        while True:
+            if not pending and (not bounded or decomp.needs_input):
+                if not padded_size:
+                    return
+                self._handle.seek(in_offset)
+                pending = self._handle.read(min(chunk_size, padded_size))
+                if not pending:
+                    return
+                in_offset += len(pending)
+                padded_size -= len(pending)
+
+            if bounded:
+                out = decomp.decompress(pending, self.CHUNK_SIZE)
+            else:
+                out = decomp.decompress(pending)
+            pending = b""
+            if out:
+                yield out
+
+    def read(self, offset, size, progress=None):
+        if offset < 0:
+            raise ValueError("Negative offset %d" % offset)
+
+        end = min(offset + size, self._size)
+        pieces = []
+        idx = bisect.bisect_right(self._outOffsets, offset) - 1
+        start = self._outOffsets[idx] if self._blocks else 0
+        while idx < len(self._blocks) and offset < end:
+            out_offset = self._outOffsets[idx]
+            if idx + 1 < len(self._blocks):
+                block_end = self._outOffsets[idx + 1]
+            else:
+                block_end = self._size
+
+            for out in self._iterBlock(idx):
+                if out_offset + len(out) > offset:
+                    pieces.append(out[max(0, offset - out_offset):
+                                      end - out_offset])
+                out_offset += len(out)
+                if progress:
+                    progress(out_offset - start, end - start)
+                if out_offset >= end:
+                    break
+            else:
+                if out_offset != block_end:
+                    raise CompressedFileError("Truncated xz block at %d" %
+                                              self._blocks[idx][1])
+
+            offset = out_offset
+            idx += 1
+        return b"".join(pieces)
+
+
+def _pad4(size):
+    """Round size up to a multiple of 4"""
+    return (size + 3) & ~3
+
+
+def _parse_xz_index(index):
+    """Parse an xz index into a list of (unpadded size, uncompressed size)
+    pairs, one per block"""
+    index = bytearray(index)
+    if not index or index[0] != 0:
+        raise CompressedFileError("Invalid xz index")
+
+    def read_multibyte(pos):
+        value = 0
+        shift = 0
+        while True:
+            if pos >= len(index):
+                raise CompressedFileError("Invalid xz index")
+            byte = index[pos]
+            value |= (byte & 0x7f) << shift
+            pos += 1
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+
+    num_records, pos = read_multibyte(1)
+    records = []
+    for _ in range(num_records):
+        unpadded, pos = read_multibyte(pos)
+        uncompressed, pos = read_multibyte(pos)
+        records.append((unpadded, uncompressed))
+    return records
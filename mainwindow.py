@@ -12,16 +12,94 @@ import qhexedit_rc # pylint: disable-msg=W0611
 
 import magic
 
-from yapsy.PluginManager import PluginManager
 from format_dissector import FormatDissector
+from plugin_watcher import PluginWatcher, ReloadingPluginManager
+from compressed_file import open_compressed, DECOMPRESS_ERRORS
+from record_dissector import is_record_array, record_to_container
 
 import construct
 
 
+class DissectThread(QtCore.QThread):
+    """Runs a dissector over a buffer without blocking the UI"""
+    dissected = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, dissector, data, parent=None):
+        super(DissectThread, self).__init__(parent)
+        self._dissector = dissector
+        self._data = data
+
+    def run(self):
+        """(QThread) dissect the buffer and emit the result"""
+        # plugins may be mid-edit, so any error is reported rather than fatal
+        try:
+            result = self._dissector.dissect(self._data)
+        except Exception as exc: # pylint: disable-msg=W0703
+            self.failed.emit(str(exc))
+        else:
+            self.dissected.emit(result)
+
+
+class ReadCancelled(Exception):
+    """A ReadThread was cancelled"""
+    pass
+
+
+class ReadThread(QtCore.QThread):
+    """Reads from a compressed file without blocking the UI"""
+    progress = QtCore.pyqtSignal(int)
+
+    def __init__(self, reader, offset, size, parent=None):
+        super(ReadThread, self).__init__(parent)
+        self._reader = reader
+        self._offset = offset
+        self._size = size
+        self._cancelled = False
+        self._percent = 0
+
+        #the data read, or the error reading it, once the thread has
+        #finished. data is None if the read was cancelled.
+        self.data = None
+        self.error = None
+
+    def cancel(self):
+        """Abandon the read as soon as possible"""
+        self._cancelled = True
+
+    def _progress(self, done, total):
+        """(Callback) the reader has decompressed more data"""
+        if self._cancelled:
+            raise ReadCancelled()
+
+        percent = min(100, done * 100 // max(total, 1))
+        if percent != self._percent:
+            self._percent = percent
+            self.progress.emit(percent)
+
+    def run(self):
+        """(QThread) read the data"""
+        try:
+            self.data = self._reader.read(self._offset, self._size,
+                                          self._progress)
+        except ReadCancelled:
+            pass
+        except DECOMPRESS_ERRORS as exc:
+            self.error = exc
+
+
 class MainWindow(QtGui.QMainWindow):
     """A configurable hex editor that supports binary templates and
     scripting through use of the construct library
     """
+
+    #how much decompressed data to show at once for compressed files
+    COMPRESSED_VIEW_SIZE = 16 * 1024 * 1024
+
+    #how many records of a fixed-layout record format to group together in
+    #the dissection tree
+    RECORD_GROUP_SIZE = 1000
+
     def __init__(self, file_name=None):
         """Initializer"""
         super(MainWindow, self).__init__()
@@ -31,6 +109,11 @@ class MainWindow(QtGui.QMainWindow):
 
         self._isUntitled = True
         self._curFile = ''
+
+        #random access reader for the current file if it's compressed, and
+        #the decompressed offset the hex editor's contents start at
+        self._compressed = None
+        self._viewOffset = 0
         self._setCurrentFile('')
 
         self.__mimeTypes = magic.Magic(mime=True)
@@ -63,12 +146,16 @@ class MainWindow(QtGui.QMainWindow):
         self._exitAct = None
         self._undoAct = None
         self._redoAct = None
+        self._gotoAct = None
         self._aboutAct = None
         self._optionsAct = None
 
         #Other
         self._hexEdit = QHexEdit()
         self._treeDissected = QTreeWidget()
+        #tree items whose children haven't been added yet, and the function
+        #to add them
+        self._lazyTreeItems = {}
         self._optionsDialog = OptionsDialog()
 
         self.__initUI()
@@ -80,16 +167,29 @@ class MainWindow(QtGui.QMainWindow):
         # Which plugin types to load and which categories to put them in
         category_mapping = {"FormatDissectors": FormatDissector}
 
-        self._manager = PluginManager(categories_filter=category_mapping)
+        self._manager = ReloadingPluginManager(
+            categories_filter=category_mapping)
         self._manager.setPluginPlaces(["plugins"])
 
         #Dissectors
         self._dissector = None
         self._availDissectors = {}
 
+        #the background dissection whose result we're waiting for, if any
+        self._dissectThread = None
+
+        #name of the dissector in use whose plugin failed to reload, so it
+        #can be picked again once the plugin is fixed
+        self._lostDissectorName = None
+
         #load in the plugins
         self.__reloadPlugins()
 
+        #pick up edits to the plugins without restarting
+        self._pluginWatcher = PluginWatcher(["plugins"], self)
+        self._pluginWatcher.filesChanged.connect(self.__pluginFilesChanged)
+        self._pluginWatcher.start()
+
 
         if file_name:
             self.loadFile(file_name)
@@ -108,6 +208,16 @@ class MainWindow(QtGui.QMainWindow):
     def closeEvent(self, event): # pylint: disable-msg=W0613
         """(PyQT event handler) the application is due to close"""
         self.writeSettings()
+        self._pluginWatcher.stop()
+
+        # don't destroy threads that are still running
+        self._dissectThread = None
+        for thread in self.findChildren(DissectThread):
+            thread.wait()
+        for thread in self.findChildren(ReadThread):
+            thread.cancel()
+            thread.wait()
+
         del self._optionsDialog
         self.close()
 
@@ -142,6 +252,10 @@ class MainWindow(QtGui.QMainWindow):
                 
         self._redoAct = QAction("&Redo", self, shortcut=QKeySequence.Redo,
                 triggered=self._hexEdit.redo)
+
+        self._gotoAct = QAction("&Go to Offset...", self, shortcut="Ctrl+G",
+                statusTip="Show the decompressed data at an offset",
+                triggered=self.dlgGotoOffset, enabled=False)
         
         self._aboutAct = QAction("&About", self,
                 statusTip="Show the application's About box",
@@ -163,6 +277,7 @@ class MainWindow(QtGui.QMainWindow):
         self._editMenu.addAction(self._undoAct)
         self._editMenu.addAction(self._redoAct)
         self._editMenu.addAction(self._saveSelReadableAct)
+        self._editMenu.addAction(self._gotoAct)
         self._editMenu.addSeparator()
         self._editMenu.addAction(self._optionsAct)
 
@@ -224,6 +339,7 @@ class MainWindow(QtGui.QMainWindow):
 
         #we don't want to be able to sort by rows (keep serialized order)
         self._treeDissected.setSortingEnabled(False)
+        self._treeDissected.itemExpanded.connect(self.__treeItemExpanded)
 
         tree_header = QTreeWidgetItem(["Name",  "Value"])
         self._treeDissected.setHeaderItem(tree_header)
@@ -262,6 +378,43 @@ class MainWindow(QtGui.QMainWindow):
         else:
             self._dissector = None
 
+    def __pluginFilesChanged(self, file_paths):
+        """(Callback) plugin files were added, changed or removed on disk
+
+        Only the affected plugins are reloaded, and the current buffer is
+        only re-dissected if its dissector was one of them.
+        """
+        removed, loaded = self._manager.reloadPlugins(file_paths)
+
+        affected = set()
+        for plugin in removed:
+            affected.add(plugin.plugin_object.name)
+            self._availDissectors.pop(plugin.plugin_object.name, None)
+
+        for plugin in loaded:
+            if plugin.error:
+                # yapsy keeps the sys.exc_info() of the failure
+                self.statusBar().showMessage("Failed to load plugin %s: %s" %
+                                             (plugin.name, plugin.error[1]),
+                                             5000)
+            elif plugin.plugin_object:
+                plug_obj = plugin.plugin_object
+                affected.add(plug_obj.name)
+                self._availDissectors[plug_obj.name] = plug_obj
+
+        if self._dissector:
+            dissector_name = self._dissector.name
+        else:
+            dissector_name = self._lostDissectorName
+
+        if dissector_name in affected:
+            self._dissector = self._availDissectors.get(dissector_name)
+            if self._dissector:
+                self._lostDissectorName = None
+            else:
+                self._lostDissectorName = dissector_name
+            self.__redissectInBackground()
+
 
 
     ############
@@ -324,7 +477,8 @@ class MainWindow(QtGui.QMainWindow):
         def write_whole(handle):
             handle.write(self._hexEdit.data())
 
-        if self._isUntitled:
+        # never write decompressed data over the compressed original
+        if self._isUntitled or self._compressed:
             return self.dlgSaveAs()
         else:
             return self.writeFile(write_whole, self._curFile, as_is=True)
@@ -334,6 +488,16 @@ class MainWindow(QtGui.QMainWindow):
         def write_whole(handle):
             handle.write(self._hexEdit.data())
 
+        # only the window of decompressed data being shown can be saved
+        if self._compressed:
+            confirm = QtGui.QMessageBox.question(self, "Save As",
+                "Only the 0x%x bytes of decompressed data being shown "
+                "(from offset 0x%x) will be saved, not the whole file.\n"
+                "Continue?" % (self._hexEdit.data().size(), self._viewOffset),
+                QtGui.QMessageBox.Ok | QtGui.QMessageBox.Cancel)
+            if confirm != QtGui.QMessageBox.Ok:
+                return False
+
         return self.writeFile(write_whole, as_is=True, op_name="Save As")
     
     def dlgSaveToReadableFile(self):
@@ -366,9 +530,16 @@ class MainWindow(QtGui.QMainWindow):
         op_name -- (Defaults to "")
         """
         if not file_name:
+            default_name = self._curFile
+            # suggest "capture.pcap" rather than "capture.pcap.gz"
+            if self._compressed:
+                file_info = QtCore.QFileInfo(self._curFile)
+                default_name = file_info.absoluteDir().filePath(
+                    file_info.completeBaseName())
+
             file_name = QtGui.QFileDialog.getSaveFileName(self,
                                                           op_name,
-                                                          self._curFile)
+                                                          default_name)
             if not file_name:
                 return False
 
@@ -387,6 +558,8 @@ class MainWindow(QtGui.QMainWindow):
         # only set the current file to the saved filename if we're
         # saving the whole file as-is
         if as_is:
+            # the hex editor's contents are the saved file now
+            self.__closeCompressed()
             self._setCurrentFile(file_name)
         self.statusBar().showMessage("File saved", 2000)
         return True
@@ -407,16 +580,143 @@ class MainWindow(QtGui.QMainWindow):
             QtGui.QMessageBox.warning(self, "QHexEdit", warning_msg)
             return
 
+        compressed = None
+        view_data = None
+        try:
+            compressed = open_compressed(unicode(file_name))
+            if compressed:
+                view_data = self.__readCompressed(compressed, 0)
+                # the user gave up on opening the file
+                if view_data is None:
+                    compressed.close()
+                    return
+        except DECOMPRESS_ERRORS as exc:
+            # show the file as-is if it can't be decompressed
+            if compressed:
+                compressed.close()
+            compressed = None
+            warning_msg = "Cannot decompress file %s:\n%s.\n" \
+                          "Showing the raw file instead." % (file_name, exc)
+            QtGui.QMessageBox.warning(self, "QHexEdit", warning_msg)
+
+        self.__closeCompressed()
+        self._compressed = compressed
+
         QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        self._hexEdit.setData(file_handle.readAll())
+        if self._compressed:
+            self._hexEdit.setData(QtCore.QByteArray(view_data))
+        else:
+            self._hexEdit.setData(file_handle.readAll())
         QtGui.QApplication.restoreOverrideCursor()
 
+        self._gotoAct.setEnabled(self._compressed is not None)
+
         self._setCurrentFile(file_name)
         self.statusBar().showMessage("File loaded", 2000)
 
         self.__autoLoadDissector(file_name)
         self.__refreshDissectionTree()
 
+    def dlgGotoOffset(self):
+        """Ask the user for an offset into the decompressed data of a
+        compressed file and show the data from there on"""
+        offset_text, ok = QtGui.QInputDialog.getText(self, "Go to Offset",
+            "Decompressed offset:", text="0x%x" % self._viewOffset)
+        if not ok:
+            return
+
+        try:
+            offset = int(unicode(offset_text), 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            QtGui.QMessageBox.warning(self, "QHexEdit",
+                                      "Invalid offset %s." % offset_text)
+            return
+
+        # moving the window throws away any edits made to it
+        if self._hexEdit.isModified():
+            answer = QtGui.QMessageBox.question(self, "Go to Offset",
+                "The data being shown has been modified.\n"
+                "Save it before moving?",
+                QtGui.QMessageBox.Save | QtGui.QMessageBox.Discard |
+                QtGui.QMessageBox.Cancel)
+            if answer == QtGui.QMessageBox.Cancel:
+                return
+            if answer == QtGui.QMessageBox.Save:
+                def write_whole(handle):
+                    handle.write(self._hexEdit.data())
+
+                if not self.writeFile(write_whole, op_name="Save Shown Data"):
+                    return
+
+        try:
+            view_data = self.__readCompressed(self._compressed, offset)
+        except DECOMPRESS_ERRORS as exc:
+            QtGui.QMessageBox.warning(self, "QHexEdit",
+                                      "Cannot decompress data at offset "
+                                      "0x%x:\n%s." % (offset, exc))
+            return
+
+        # cancelled
+        if view_data is None:
+            return
+
+        if not view_data:
+            QtGui.QMessageBox.warning(self, "QHexEdit",
+                                      "Offset 0x%x is past the end of the "
+                                      "file." % offset)
+            return
+
+        self._viewOffset = offset
+        self._hexEdit.setData(QtCore.QByteArray(view_data))
+        self._hexEdit.setAddressOffset(offset)
+        self.statusBar().showMessage("Showing data from offset 0x%x" % offset,
+                                     2000)
+        self.__refreshDissectionTree()
+
+    def __readCompressed(self, compressed, offset):
+        """Read the window of decompressed data starting at offset on a
+        separate thread, showing a progress dialog that lets the user cancel
+
+        Getting to an offset deep in a compressed file can mean
+        decompressing everything before it.
+
+        Returns None if the user cancelled
+        """
+        thread = ReadThread(compressed, offset, self.COMPRESSED_VIEW_SIZE,
+                            self)
+        progress = QtGui.QProgressDialog("Decompressing...", "Cancel",
+                                         0, 100, self)
+        progress.setWindowModality(QtCore.Qt.WindowModal)
+        # don't flash the dialog up for quick reads
+        progress.setMinimumDuration(500)
+        thread.progress.connect(progress.setValue)
+        progress.canceled.connect(thread.cancel)
+
+        # keep the UI running until the read is done
+        loop = QtCore.QEventLoop()
+        thread.finished.connect(loop.quit)
+        thread.start()
+        loop.exec_()
+
+        progress.reset()
+        progress.deleteLater()
+        thread.deleteLater()
+
+        if thread.error:
+            raise thread.error
+        return thread.data
+
+    def __closeCompressed(self):
+        """Stop reading from the current compressed file, if any"""
+        if self._compressed:
+            self._compressed.close()
+        self._compressed = None
+        self._viewOffset = 0
+        self._hexEdit.setAddressOffset(0)
+        self._gotoAct.setEnabled(False)
+
     def _setCurrentFile(self, file_name):
         """Set the current filename"""
         self._curFile = file_name
@@ -461,6 +761,12 @@ class MainWindow(QtGui.QMainWindow):
         
         #don't use a dissector if we can't auto-assign one
         self._dissector = None
+        self._lostDissectorName = None
+
+        #match compressed files on what they decompress to, so
+        #"capture.pcap.gz" is treated like "capture.pcap"
+        if self._compressed:
+            file_name = QtCore.QFileInfo(file_name).completeBaseName()
 
         #first try and assign a dissector by extension
         for dissector in self._availDissectors.values():
@@ -470,27 +776,71 @@ class MainWindow(QtGui.QMainWindow):
                     return
 
         #now try to assign a dissector by mimetype
-        file_mimetype = self.__mimeTypes.from_file(file_name)
+        if self._compressed:
+            file_mimetype = self.__mimeTypes.from_buffer(
+                self._hexEdit.data().data())
+        else:
+            file_mimetype = self.__mimeTypes.from_file(file_name)
 
         if not file_mimetype:
             return
 
         for dissector in self._availDissectors.values():
             for supp_mimetype in dissector.file_mimetypes:
-                if file_name == supp_mimetype:
+                if file_mimetype == supp_mimetype:
                     self._dissector = dissector
                     return
 
     def __refreshDissectionTree(self):
         """Refresh the tree of dissected data with data from the hex editor"""
         self._treeDissected.clear()
+        self._lazyTreeItems = {}
+
+        #any background dissection in progress is now out of date
+        self._dissectThread = None
 
         #only refresh if we have data and a dissector
         if self._dissector and self._hexEdit.data():
-            self.__addToDissectionTree(
-                self._dissector.dissect(self._hexEdit.data().data()))
+            # the data may not be dissectable, e.g. a window of a compressed
+            # file that starts mid-file
+            try:
+                dissected = self._dissector.dissect(self._hexEdit.data().data())
+            except Exception as exc: # pylint: disable-msg=W0703
+                self.statusBar().showMessage("Dissection failed: %s" % exc,
+                                             5000)
+                return
+            self.__addToDissectionTree(dissected)
             
     
+    def __redissectInBackground(self):
+        """Refresh the tree of dissected data with data from the hex editor,
+        dissecting it on a separate thread"""
+        self._treeDissected.clear()
+        self._lazyTreeItems = {}
+        self._dissectThread = None
+
+        if self._dissector and self._hexEdit.data():
+            thread = DissectThread(self._dissector,
+                                   self._hexEdit.data().data(), self)
+            thread.dissected.connect(self.__backgroundDissected)
+            thread.failed.connect(self.__backgroundDissectFailed)
+            thread.finished.connect(thread.deleteLater)
+            self._dissectThread = thread
+            thread.start()
+
+    def __backgroundDissected(self, dissected):
+        """(Callback) a background dissection finished"""
+        if self.sender() is self._dissectThread:
+            self._dissectThread = None
+            self.__addToDissectionTree(dissected)
+            self.statusBar().showMessage("Dissection refreshed", 2000)
+
+    def __backgroundDissectFailed(self, error):
+        """(Callback) a background dissection raised an error"""
+        if self.sender() is self._dissectThread:
+            self._dissectThread = None
+            self.statusBar().showMessage("Dissection failed: %s" % error, 5000)
+    
     def __addToDissectionTree(self, attr_container, parent=None):
         """Recursively add a Construct container and its children to the
         dissected data tree widget
@@ -530,6 +880,9 @@ class MainWindow(QtGui.QMainWindow):
                 #value is a container
                 if isinstance(attr_v,  construct.Container):
                     add_container_to_tree(attr_k, attr_v)
+                #value is an array of fixed-layout records
+                elif is_record_array(attr_v):
+                    self.__addRecordArrayToTree(attr_k, attr_v, parent)
                 #value is list-like
                 elif isinstance(attr_v, (list, tuple)):
                     elem_idx = 0
@@ -549,6 +902,61 @@ class MainWindow(QtGui.QMainWindow):
                 else:
                     add_item_to_tree(QTreeWidgetItem([attr_k, str(attr_v)]))
 
+    def __addLazyTreeItem(self, item, fill_func, parent=None):
+        """Add a tree item whose children are only added by
+        fill_func(item) once it's expanded"""
+        if not parent:
+            self._treeDissected.addTopLevelItem(item)
+        else:
+            parent.addChild(item)
+        item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+        self._lazyTreeItems[item] = fill_func
+
+    def __treeItemExpanded(self, item):
+        """(Callback) a tree item was expanded, fill in its children if
+        that hasn't been done yet"""
+        fill_func = self._lazyTreeItems.pop(item, None)
+        if fill_func:
+            fill_func(item)
+
+    def __addRecordArrayToTree(self, name, records, parent=None):
+        """Add a NumPy array of fixed-layout records to the dissected data
+        tree widget
+
+        Records can number in the millions, so they're grouped into ranges
+        and neither the records in a range nor their fields are added to
+        the tree until it's expanded.
+
+        Arguments:
+        name -- Name of the array
+        records -- NumPy structured array of records
+
+        Keyword Arguments:
+        parent -- Reference to the tree item that represents the container
+                  holding the array (default None)
+        """
+        def add_records(group_item, start, group):
+            """Add a lazily filled tree item for each record in group"""
+            for idx, record in enumerate(group):
+                record_item = QTreeWidgetItem(["%s[%d]" % (name, start + idx),
+                                               ""])
+                self.__addLazyTreeItem(record_item,
+                    lambda item, record=record: self.__addToDissectionTree(
+                        record_to_container(record), item),
+                    group_item)
+
+        if len(records) <= self.RECORD_GROUP_SIZE:
+            add_records(parent, 0, records)
+            return
+
+        for start in range(0, len(records), self.RECORD_GROUP_SIZE):
+            group = records[start:start + self.RECORD_GROUP_SIZE]
+            group_name = "%s[%d-%d]" % (name, start, start + len(group) - 1)
+            self.__addLazyTreeItem(QTreeWidgetItem([group_name, ""]),
+                lambda item, start=start, group=group: add_records(
+                    item, start, group),
+                parent)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright 2011 Jordan Milne
+
+import hashlib
+import os
+import sys
+
+from PyQt4 import QtCore
+
+from yapsy.PluginInfo import PluginInfo
+from yapsy.PluginManager import PluginManager
+
+
+PLUGIN_INFO_EXT = ".yapsy-plugin"
+PLUGIN_EXTS = (".py", PLUGIN_INFO_EXT)
+
+
+class PluginWatcher(QtCore.QObject):
+    """Polls the plugin directories and reports plugin files that were
+    added, changed or removed
+    """
+    filesChanged = QtCore.pyqtSignal(list)
+
+    POLL_INTERVAL = 1000
+
+    def __init__(self, places, parent=None):
+        super(PluginWatcher, self).__init__(parent)
+        self._places = places
+
+        #(mtime, size) and content hash of every plugin file we know of
+        self._stats = {}
+        #_scan() reuses the digests of files that haven't changed, so this
+        #has to exist before the first scan
+        self._digests = {}
+        self._digests = self._scan()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._poll)
+
+    def start(self):
+        """Start watching for changes"""
+        self._timer.start(self.POLL_INTERVAL)
+
+    def stop(self):
+        """Stop watching for changes"""
+        self._timer.stop()
+
+    def _scan(self):
+        """Get the content hash of every plugin file, only re-reading files
+        whose mtime or size changed since the last scan"""
+        digests = {}
+        for place in self._places:
+            for dir_path, _, file_names in os.walk(os.path.abspath(place)):
+                for file_name in file_names:
+                    if not file_name.endswith(PLUGIN_EXTS):
+                        continue
+
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(path)
+                        file_stat = (stat.st_mtime, stat.st_size)
+                        if self._stats.get(path) == file_stat:
+                            digests[path] = self._digests[path]
+                        else:
+                            with open(path, "rb") as handle:
+                                digests[path] = \
+                                    hashlib.md5(handle.read()).hexdigest()
+                            self._stats[path] = file_stat
+                    except (IOError, OSError):
+                        #removed while we were looking at it
+                        continue
+
+        for path in list(self._stats):
+            if path not in digests:
+                del self._stats[path]
+        return digests
+
+    def _poll(self):
+        """(Callback) check the plugin files for changes"""
+        digests = self._scan()
+        changed = sorted(path for path in set(digests) | set(self._digests)
+                         if digests.get(path) != self._digests.get(path))
+        self._digests = digests
+
+        if changed:
+            self.filesChanged.emit(changed)
+
+
+class ReloadingPluginManager(PluginManager):
+    """PluginManager that can reload individual plugins instead of
+    locating and loading every plugin again
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ReloadingPluginManager, self).__init__(*args, **kwargs)
+
+        #plugin info file for each plugin module path, whether or not the
+        #plugin loaded successfully
+        self._infoFiles = {}
+
+    def loadPlugins(self, *args, **kwargs):
+        """Load the located plugin candidates"""
+        for info_file, _, plugin_info in getattr(self, "_candidates", []):
+            self._infoFiles[plugin_info.path] = info_file
+        return super(ReloadingPluginManager, self).loadPlugins(*args,
+                                                               **kwargs)
+
+    def reloadPlugins(self, file_paths):
+        """Reload the plugins described by or implemented in any of
+        file_paths, loading any new plugins and dropping deleted ones
+
+        Returns a tuple of the plugin infos that were removed and those that
+        were (re)loaded. Plugins that failed to load, including those whose
+        info file couldn't be read, have their error set.
+        """
+        info_files = set()
+        for path in map(os.path.abspath, file_paths):
+            if path.endswith(PLUGIN_INFO_EXT):
+                info_files.add(path)
+            else:
+                module_path = os.path.splitext(path)[0]
+                if module_path in self._infoFiles:
+                    info_files.add(self._infoFiles[module_path])
+
+        #drop the old plugins, yapsy keeps the plugins of a category and
+        #the info files they came from in matching lists
+        removed = []
+        for category_name, plugins in self.category_mapping.items():
+            category_files = self._category_file_mapping[category_name]
+            for idx in reversed(range(len(category_files))):
+                if category_files[idx] in info_files:
+                    removed.append(plugins.pop(idx))
+                    del category_files[idx]
+
+        for module_path, info_file in list(self._infoFiles.items()):
+            if info_file in info_files:
+                del self._infoFiles[module_path]
+
+        self._candidates = []
+        failed = []
+        locator = self.getPluginLocator()
+        for info_file in sorted(info_files):
+            if not os.path.isfile(info_file):
+                continue
+
+            # the info file may be half-written
+            try:
+                plugin_info, _ = locator.gatherCorePluginInfo(
+                    os.path.dirname(info_file), os.path.basename(info_file))
+                if not plugin_info:
+                    raise ValueError("%s is not a valid plugin info file" %
+                                     info_file)
+            except Exception: # pylint: disable-msg=W0703
+                plugin_info = PluginInfo(os.path.basename(info_file),
+                                         os.path.splitext(info_file)[0])
+                plugin_info.error = sys.exc_info()
+                failed.append(plugin_info)
+                continue
+
+            self._candidates.append((info_file, plugin_info.path,
+                                     plugin_info))
+
+        return removed, failed + self.loadPlugins()
@@ -0,0 +1,28 @@
+
+import record_dissector
+
+
+class UtmpDissector(record_dissector.RecordDissector):
+    
+    name = "utmp login records"
+
+    file_exts = ["utmp", "wtmp", "btmp"]
+    file_mimetypes = []
+
+    #struct utmp as laid out on x86 / x86_64 Linux
+    record_layout = [
+        ("ut_type", "h"),
+        ("_pad", "2x"),
+        ("ut_pid", "i"),
+        ("ut_line", "32s"),
+        ("ut_id", "4s"),
+        ("ut_user", "32s"),
+        ("ut_host", "256s"),
+        ("e_termination", "h"),
+        ("e_exit", "h"),
+        ("ut_session", "i"),
+        ("tv_sec", "i"),
+        ("tv_usec", "i"),
+        ("ut_addr_v6", "4I"),
+        ("_unused", "20x"),
+    ]
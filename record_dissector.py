@@ -0,0 +1,202 @@
+#base class for dissectors of fixed-layout record formats
+#
+#Formats that are a fixed-size header followed by an array of fixed-size
+#records don't need to be parsed field by field with construct. Subclasses
+#of RecordDissector declare their layouts as lists of (name, format) pairs
+#using struct format codes, e.g.
+#
+#    header_layout = [("magic", "I"), ("count", "I")]
+#    record_layout = [("type", "h"), ("_pad", "2x"), ("name", "32s")]
+#
+#The record layout is compiled to a NumPy structured dtype so the whole
+#record array is decoded with a single numpy.frombuffer() over the data
+#without copying it. If NumPy isn't available we fall back to unpacking
+#each record with a precompiled struct.Struct.
+#
+#Plugins should import the module rather than the class
+#("import record_dissector"), otherwise yapsy will pick up RecordDissector
+#itself as a plugin.
+
+import struct
+
+import construct
+
+from format_dissector import FormatDissector
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#struct format codes and the NumPy type codes with the same (standard) size
+_NUMPY_CODES = {
+    "b": "i1", "B": "u1", "?": "b1",
+    "h": "i2", "H": "u2",
+    "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+    "q": "i8", "Q": "u8",
+    "e": "f2", "f": "f4", "d": "f8",
+}
+
+_NUMPY_BYTE_ORDERS = {"<": "<", ">": ">", "!": ">", "=": "="}
+
+
+class RecordLayout(object):
+    """A record layout compiled to a struct.Struct and (if NumPy is
+    available) an equivalent NumPy structured dtype"""
+
+    def __init__(self, fields, byte_order="<"):
+        """Initializer
+
+        Arguments:
+        fields -- list of (name, format) pairs, where format is a single
+                  struct format code with an optional repeat count
+
+        Keyword Arguments:
+        byte_order -- struct byte order character, one of "<", ">", "!"
+                      or "=" (Defaults to "<")
+        """
+        if byte_order not in _NUMPY_BYTE_ORDERS:
+            raise ValueError("Unsupported byte order %r" % byte_order)
+
+        self.fields = []
+        self.struct = struct.Struct(byte_order +
+                                    "".join(fmt for _, fmt in fields))
+        self.size = self.struct.size
+        self.dtype = None
+
+        names = []
+        formats = []
+        offsets = []
+        offset = 0
+        for name, fmt in fields:
+            count = int(fmt[:-1] or 1)
+            code = fmt[-1]
+            field_size = struct.calcsize(byte_order + fmt)
+
+            #padding takes up space but doesn't produce a value
+            if code != "x":
+                if code == "s":
+                    np_format = "S%d" % count
+                    n_values = 1
+                elif code in _NUMPY_CODES:
+                    np_format = _NUMPY_BYTE_ORDERS[byte_order] + \
+                                _NUMPY_CODES[code]
+                    if count != 1:
+                        np_format = (np_format, count)
+                    n_values = count
+                else:
+                    raise ValueError("Unsupported format %r for field %r" %
+                                     (fmt, name))
+
+                self.fields.append((name, code, n_values))
+                names.append(name)
+                formats.append(np_format)
+                offsets.append(offset)
+
+            offset += field_size
+
+        if numpy is not None:
+            self.dtype = numpy.dtype({"names": names,
+                                      "formats": formats,
+                                      "offsets": offsets,
+                                      "itemsize": self.size})
+
+    def unpackFrom(self, data, offset=0):
+        """Unpack a single record at offset into a construct Container"""
+        values = self.struct.unpack_from(data, offset)
+        container = construct.Container()
+        idx = 0
+        for name, code, n_values in self.fields:
+            if code == "s":
+                #match NumPy, which strips trailing NULs from strings
+                container[name] = values[idx].rstrip(b"\0")
+            elif n_values == 1:
+                container[name] = values[idx]
+            else:
+                container[name] = list(values[idx:idx + n_values])
+            idx += n_values
+        return container
+
+    def unpackArray(self, data, count, offset=0):
+        """Unpack count consecutive records starting at offset
+
+        Returns a NumPy structured array viewing data if NumPy is
+        available, otherwise a list of construct Containers
+        """
+        if self.dtype is not None:
+            return numpy.frombuffer(data, self.dtype, count, offset)
+
+        return [self.unpackFrom(data, offset + idx * self.size)
+                for idx in range(count)]
+
+
+class RecordDissector(FormatDissector):
+    """Dissector for formats made of a fixed-layout header followed by an
+    array of fixed-layout records"""
+
+    header_layout = []
+    record_layout = []
+    byte_order = "<"
+
+    def __init__(self):
+        super(RecordDissector, self).__init__()
+        self._header = None
+        self._record = None
+
+    def compileLayouts(self):
+        """Compile the header and record layouts (only done once)"""
+        if self._record is None:
+            self._header = RecordLayout(self.header_layout, self.byte_order)
+            self._record = RecordLayout(self.record_layout, self.byte_order)
+
+    def recordsOffset(self, header):
+        """Offset of the first record, defaults to right after the header"""
+        return self._header.size
+
+    def recordCount(self, header):
+        """Number of records declared by the header, or None to read as
+        many complete records as the data holds"""
+        return None
+
+    def dissect(self, data):
+        self.compileLayouts()
+
+        dissected = construct.Container()
+        header = construct.Container()
+        if self.header_layout:
+            header = self._header.unpackFrom(data)
+            dissected["header"] = header
+
+        #header-only formats have no records
+        if not self._record.size:
+            return dissected
+
+        #the header may point past the end of truncated data
+        offset = min(self.recordsOffset(header), len(data))
+        count = max(0, (len(data) - offset) // self._record.size)
+        declared_count = self.recordCount(header)
+        if declared_count is not None:
+            count = min(count, max(0, declared_count))
+
+        dissected["records"] = self._record.unpackArray(data, count, offset)
+        return dissected
+
+
+def is_record_array(value):
+    """Is value a NumPy structured array returned by RecordDissector?"""
+    return numpy is not None and isinstance(value, numpy.ndarray) and \
+        value.dtype.names is not None
+
+
+def record_to_container(record):
+    """Convert an element of a NumPy structured array to a construct
+    Container"""
+    container = construct.Container()
+    for name in record.dtype.names:
+        value = record[name]
+        #numpy scalars and subarrays become plain python values
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        container[name] = value
+    return container